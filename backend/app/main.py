@@ -1,26 +1,46 @@
 from fastapi import FastAPI, File, UploadFile, Form, Request, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse, JSONResponse
+from starlette.datastructures import Headers
 import stripe, os
 from openai import AsyncOpenAI
 import base64
+import hashlib
+from abc import ABC, abstractmethod
+import asyncio
+import math
+import time
+import random
 import httpx
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from PIL import Image
+from PIL import Image, ImageOps
 from io import BytesIO
 
 # Load environment variables
 load_dotenv()
 
 # Initialize APIs
+# Image generation providers, in order of preference (see ProviderPool below)
+IMAGE_PROVIDERS = [spec.strip() for spec in os.getenv("IMAGE_PROVIDERS", "openai").split(",") if spec.strip()]
+
 # Get OpenAI API key
 openai_key = os.getenv("OPENAI_API_KEY")
-if not openai_key:
+if "openai" in IMAGE_PROVIDERS and not openai_key:
     raise ValueError("OPENAI_API_KEY not set in .env file")
 
+# Get getimg.ai API key
+getimg_key = os.getenv("GETIMG_API_KEY")
+if "getimg" in IMAGE_PROVIDERS and not getimg_key:
+    raise ValueError("GETIMG_API_KEY not set in .env file")
+
 stripe_key = os.getenv("STRIPE_SECRET_KEY")
 if not stripe_key:
-    raise ValueError("STRIPE_SECRET_KEY not set")
+    # Local runs against fake providers don't need payments
+    if not all(spec.startswith("fake") for spec in IMAGE_PROVIDERS):
+        raise ValueError("STRIPE_SECRET_KEY not set")
+    print("Warning: STRIPE_SECRET_KEY not set. Checkout will fail (only fake image providers configured).")
 stripe.api_key = stripe_key
 
 # Add Stripe Webhook Secret
@@ -31,26 +51,757 @@ if not stripe_webhook_secret:
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
 app = FastAPI()
-# CORS for frontend
+
+# Define Price Options (Map IDs to amount in cents and credits)
+PRICE_OPTIONS = {
+    "price_3": {"amount": 300, "credits": 10, "name": "10 Photo Credits Pack"},
+    "price_10": {"amount": 1000, "credits": 50, "name": "50 Photo Credits Pack"}
+}
+
+# Provider health and hedging
+EXPECTED_GENERATION_SECONDS = float(os.getenv("EXPECTED_GENERATION_SECONDS", "30"))  # seed for the latency EWMAs (also used by admission control)
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv("PROVIDER_FAILURE_THRESHOLD", "3"))  # consecutive errors before marking unhealthy
+PROVIDER_COOLDOWN = float(os.getenv("PROVIDER_COOLDOWN", "60"))  # seconds an unhealthy provider is skipped
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "60"))  # per call; a hung provider fails over instead of stalling
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+HEDGE_AFTER_FACTOR = float(os.getenv("HEDGE_AFTER_FACTOR", "1.5"))  # x latency EWMA, until enough samples for a p95
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))  # max fraction of requests that may be hedged
+PROVIDER_DEMOTE_RATIO = float(os.getenv("PROVIDER_DEMOTE_RATIO", "2.0"))  # primary is demoted when this much slower than another
+
+# Image generation providers. Each adapter takes the preprocessed PNG bytes and the
+# final prompt and returns the generated image bytes. ProviderPool tracks health and
+# latency per provider, hedges slow calls to a second provider and fails over on errors.
+class ProviderRequestError(Exception):
+    """Upstream HTTP error from an adapter whose client doesn't raise a status-carrying exception itself."""
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Statuses that mean the request itself was rejected (bad input, too large, content policy). Anything
+# else, including 401/402/403/404 from a revoked key, exhausted credit or a bad model, is the provider's fault.
+REQUEST_ERROR_STATUSES = (400, 413, 422)
+CONTENT_POLICY_CODES = ("content_policy_violation", "moderation_blocked")
+
+def is_provider_fault(e: Exception) -> bool:
+    """Whether an error should count against the provider and fail over, rather than go back to the caller."""
+    if getattr(e, "code", None) in CONTENT_POLICY_CODES:
+        return False
+    return getattr(e, "status_code", None) not in REQUEST_ERROR_STATUSES
+
+class ImageProvider(ABC):
+    name = "provider"
+
+    @abstractmethod
+    async def edit(self, image_bytes: bytes, prompt: str) -> bytes:
+        """Return the generated image bytes for the preprocessed PNG and final prompt."""
+
+class OpenAIProvider(ImageProvider):
+    """OpenAI images.edit with gpt-image-1."""
+    name = "openai"
+
+    async def edit(self, image_bytes: bytes, prompt: str) -> bytes:
+        # Initialize OpenAI Client with custom HTTP client to disable proxy env vars
+        custom_http_client = httpx.AsyncClient(trust_env=False)
+        # Retries are ProviderPool's job (failover), not the SDK's
+        client = AsyncOpenAI(api_key=openai_key, http_client=custom_http_client, max_retries=0, timeout=PROVIDER_TIMEOUT)
+        print(f"Calling OpenAI images.edit with model gpt-image-1...")
+        async with client:
+            response = await client.images.edit(
+                model="gpt-image-1",
+                image=("uploaded_image.png", image_bytes, "image/png"), # Pass tuple: (filename, raw_bytes, mimetype)
+                prompt=prompt,
+                n=1,
+                size="1024x1024" # Standard size
+            )
+        return base64.b64decode(response.data[0].b64_json)
+
+class GetimgProvider(ImageProvider):
+    """getimg.ai Stable Diffusion XL image-to-image (see test_api_formats.py / find_animagine.py)."""
+    name = "getimg"
+    api_url = "https://api.getimg.ai/v1/stable-diffusion-xl/image-to-image"
+
+    def __init__(self):
+        self.model = os.getenv("GETIMG_MODEL")  # e.g. an Animagine model ID; getimg's default SDXL model if unset
+        self.strength = float(os.getenv("GETIMG_STRENGTH", "0.7"))
+        self.steps = int(os.getenv("GETIMG_STEPS", "30"))
+
+    async def edit(self, image_bytes: bytes, prompt: str) -> bytes:
+        headers = {
+            "accept": "application/json",
+            "content-type": "application/json",
+            "authorization": f"Bearer {getimg_key}"
+        }
+        payload = {
+            "prompt": prompt,
+            "image": base64.b64encode(image_bytes).decode('utf-8'),
+            "negative_prompt": "text, watermark",
+            "strength": self.strength,
+            "steps": self.steps,
+            "guidance": 7.5,
+            "output_format": "png"
+        }
+        if self.model:
+            payload["model"] = self.model
+        print(f"Calling getimg.ai SDXL image-to-image...")
+        async with httpx.AsyncClient(timeout=PROVIDER_TIMEOUT, trust_env=False) as client:
+            response = await client.post(self.api_url, json=payload, headers=headers)
+        if response.status_code >= 400:
+            raise ProviderRequestError(response.status_code, f"getimg.ai returned {response.status_code}: {response.text}")
+        return base64.b64decode(response.json()["image"])
+
+class FakeProvider(ImageProvider):
+    """Local stand-in for development and load tests: `fake:<latency seconds>:<failure rate>`."""
+
+    def __init__(self, name: str, latency: float = 1.0, failure_rate: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    async def edit(self, image_bytes: bytes, prompt: str) -> bytes:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.failure_rate:
+            raise RuntimeError(f"{self.name} simulated failure")
+        img = ImageOps.posterize(Image.open(BytesIO(image_bytes)).convert("RGB"), 3)
+        buffered = BytesIO()
+        img.save(buffered, format="PNG")
+        return buffered.getvalue()
+
+def create_provider(spec: str) -> ImageProvider:
+    if spec == "openai":
+        return OpenAIProvider()
+    if spec == "getimg":
+        return GetimgProvider()
+    if spec.startswith("fake"):
+        parts = spec.split(":")
+        latency = float(parts[1]) if len(parts) > 1 else 1.0
+        failure_rate = float(parts[2]) if len(parts) > 2 else 0.0
+        return FakeProvider(spec, latency, failure_rate)
+    raise ValueError(f"Unknown image provider '{spec}' in IMAGE_PROVIDERS")
+
+class ProviderStats:
+    """Latency EWMA, recent-latency p95 and circuit-breaker state for one provider."""
+
+    def __init__(self, expected_seconds: float):
+        self.latency_ewma = expected_seconds
+        self.latencies = deque(maxlen=100)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.last_sample = 0.0
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def p95(self):
+        """p95 of recent latencies, or None until there are enough samples to trust it."""
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def stale(self) -> bool:
+        """No latency sample for a cooldown period; the estimates may no longer reflect the provider."""
+        return time.monotonic() - self.last_sample > PROVIDER_COOLDOWN
+
+    def record_latency(self, elapsed: float):
+        self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * elapsed
+        self.latencies.append(elapsed)
+        self.last_sample = time.monotonic()
+
+    def record_success(self, elapsed: float):
+        self.record_latency(elapsed)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def record_cancelled(self, elapsed: float):
+        """A call cancelled after `elapsed` seconds (lost a hedge race) would have taken at least that long."""
+        if elapsed > self.latency_ewma:
+            self.record_latency(elapsed)
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= PROVIDER_FAILURE_THRESHOLD:
+            self.unhealthy_until = time.monotonic() + PROVIDER_COOLDOWN
+
+class AllProvidersFailed(Exception):
+    def __init__(self, errors: list):
+        super().__init__("; ".join(f"{name}: {e}" for name, e in errors))
+        self.errors = errors
+        # Pass through upstream 5xx; provider-side 4xx (bad key, no credit, rate limit) are a bad gateway to the client
+        status_code = getattr(errors[-1][1], "status_code", None) if errors else None
+        self.status_code = status_code if isinstance(status_code, int) and status_code >= 500 else 502
+
+class ProviderPool:
+    """Routes a generation to the healthiest preferred provider, hedging and failing over to the others."""
+
+    def __init__(self, providers: list, hedge: bool):
+        names = [provider.name for provider in providers]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            # Providers are tracked by name, so duplicates would share (and hide) each other's stats
+            raise ValueError(f"Duplicate image providers in IMAGE_PROVIDERS: {', '.join(duplicates)}")
+        self.providers = providers
+        self.hedge = hedge
+        self.stats = {provider.name: ProviderStats(EXPECTED_GENERATION_SECONDS) for provider in providers}
+        # Retry-budget style token bucket: each request earns HEDGE_BUDGET tokens, each hedge costs one
+        self.hedge_tokens = 1.0
+
+    def clearly_slower(self, provider: ImageProvider, other: ImageProvider) -> bool:
+        stats, other_stats = self.stats[provider.name], self.stats[other.name]
+        if stats.stale():
+            return False  # give a provider without recent samples another chance as primary
+        if stats.latency_ewma > PROVIDER_DEMOTE_RATIO * other_stats.latency_ewma:
+            return True
+        p95, other_p95 = stats.p95(), other_stats.p95()
+        return p95 is not None and other_p95 is not None and p95 > PROVIDER_DEMOTE_RATIO * other_p95
+
+    def ordered(self) -> list:
+        """
+        Healthy providers in configured order, except that the preferred one is demoted when another healthy
+        provider is clearly faster. Unhealthy providers follow as a last resort.
+        """
+        healthy = [p for p in self.providers if self.stats[p.name].healthy()]
+        if len(healthy) > 1:
+            fastest = min(healthy, key=lambda p: self.stats[p.name].latency_ewma)
+            if self.clearly_slower(healthy[0], fastest):
+                healthy.remove(fastest)
+                healthy.insert(0, fastest)
+        return healthy + [p for p in self.providers if p not in healthy]
+
+    def hedge_delay(self, provider: ImageProvider) -> float:
+        stats = self.stats[provider.name]
+        p95 = stats.p95()
+        return p95 if p95 is not None else HEDGE_AFTER_FACTOR * stats.latency_ewma
+
+    async def _call(self, provider: ImageProvider, image_bytes: bytes, prompt: str) -> bytes:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(provider.edit(image_bytes, prompt), timeout=PROVIDER_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats[provider.name].record_cancelled(time.monotonic() - started)
+            self.stats[provider.name].record_failure()
+            raise TimeoutError(f"{provider.name} timed out after {PROVIDER_TIMEOUT:g}s")
+        except asyncio.CancelledError:
+            # Lost a hedge race: says nothing about health, but bounds the latency from below
+            self.stats[provider.name].record_cancelled(time.monotonic() - started)
+            raise
+        except Exception as e:
+            if is_provider_fault(e):
+                self.stats[provider.name].record_failure()
+            raise
+        self.stats[provider.name].record_success(time.monotonic() - started)
+        return result
+
+    async def generate(self, image_bytes: bytes, prompt: str):
+        """Return (provider name, image bytes) from the first provider to succeed."""
+        candidates = self.ordered()
+        pending = {}
+        errors = []
+        hedge_at = None
+
+        def launch():
+            provider = candidates.pop(0)
+            pending[asyncio.create_task(self._call(provider, image_bytes, prompt))] = provider
+            return provider
+
+        primary = launch()
+        self.hedge_tokens = min(self.hedge_tokens + HEDGE_BUDGET, 10.0)
+        if self.hedge and candidates and self.stats[candidates[0].name].healthy():
+            hedge_at = time.monotonic() + self.hedge_delay(primary)
+        try:
+            while pending:
+                timeout = None
+                if hedge_at is not None:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Primary is slower than its p95: race a second provider against it
+                    hedge_at = None
+                    if candidates and self.hedge_tokens >= 1.0:
+                        self.hedge_tokens -= 1.0
+                        provider = launch()
+                        print(f"Hedging: {primary.name} exceeded {self.hedge_delay(primary):.1f}s, also trying {provider.name}")
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        return provider.name, task.result()
+                    if not is_provider_fault(error):
+                        # Rejected because of the request itself (e.g. content policy): don't resubmit it elsewhere
+                        print(f"Provider {provider.name} rejected the request: {error}")
+                        raise error
+                    print(f"Provider {provider.name} failed: {error}")
+                    errors.append((provider.name, error))
+                if not pending and candidates:
+                    # Everything in flight failed: fail over to the next provider
+                    hedge_at = None
+                    provider = launch()
+                    print(f"Failing over to {provider.name}")
+            raise AllProvidersFailed(errors)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def status(self) -> list:
+        return [
+            {
+                "name": provider.name,
+                "healthy": self.stats[provider.name].healthy(),
+                "latency_ewma": round(self.stats[provider.name].latency_ewma, 2),
+                "p95": self.stats[provider.name].p95(),
+                "consecutive_failures": self.stats[provider.name].consecutive_failures,
+            }
+            for provider in self.providers
+        ]
+
+provider_pool = ProviderPool([create_provider(spec) for spec in IMAGE_PROVIDERS], HEDGE_REQUESTS)
+
+# Output negotiation: the upstream always returns a 1024x1024 PNG, which is heavy
+# for mobile clients. Clients can ask for a lighter format/size via the Accept
+# header or the `output_format` / `output_size` form fields.
+OUTPUT_FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+# Accept-header preference order when the client lists several formats with equal q
+OUTPUT_PREFERENCE = ["avif", "webp", "jpeg", "png"]
+OUTPUT_SIZES = (256, 512, 768, 1024)
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", "80"))
+GENERATED_DIR = os.getenv("GENERATED_DIR", os.path.join(os.path.dirname(__file__), "generated"))
+os.makedirs(GENERATED_DIR, exist_ok=True)
+# Stored images (original + variants) are deleted after GENERATED_TTL seconds, oldest first beyond GENERATED_MAX_MB
+GENERATED_TTL = float(os.getenv("GENERATED_TTL", "86400"))
+GENERATED_MAX_BYTES = int(os.getenv("GENERATED_MAX_MB", "500")) * 1024 * 1024
+
+# Pillow only registers AVIF when built with libavif (or the avif plugin is installed)
+if "AVIF" not in Image.SAVE:
+    OUTPUT_PREFERENCE.remove("avif")
+    print("Warning: Pillow has no AVIF support, AVIF output disabled.")
+
+# Transcoding is CPU bound; keep it off the event loop in a small worker pool
+transcode_pool = ThreadPoolExecutor(max_workers=int(os.getenv("TRANSCODE_WORKERS", "2")))
+
+def negotiate_output(accept: str, output_format: str, output_size: int):
+    """Pick the output format and size from the form fields, falling back to the Accept header."""
+    fmt = None
+    if output_format:
+        fmt = output_format.lower().replace("jpg", "jpeg")
+        if fmt not in OUTPUT_PREFERENCE:
+            raise ValueError(f"Unsupported output_format '{output_format}'")
+    elif accept:
+        # Only explicitly listed image types count; */* and image/* keep the original PNG
+        best_q = 0.0
+        for part in accept.split(","):
+            media_type, _, params = part.strip().partition(";")
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            for candidate in OUTPUT_PREFERENCE:
+                if OUTPUT_FORMATS[candidate][1] != media_type.strip().lower() or q <= 0:
+                    continue
+                # Higher q wins; equal q goes to the format earlier in OUTPUT_PREFERENCE
+                if q > best_q or (q == best_q and OUTPUT_PREFERENCE.index(candidate) < OUTPUT_PREFERENCE.index(fmt)):
+                    fmt, best_q = candidate, q
+    fmt = fmt or "png"
+
+    size = 1024
+    if output_size:
+        if output_size not in OUTPUT_SIZES:
+            raise ValueError(f"Unsupported output_size {output_size}, expected one of {OUTPUT_SIZES}")
+        size = output_size
+    return fmt, size
+
+def transcode_image(image_bytes: bytes, fmt: str, size: int) -> bytes:
+    """Re-encode (and optionally downscale) an image. Runs in the transcode pool."""
+    img = Image.open(BytesIO(image_bytes))
+    if img.width > size or img.height > size:
+        img.thumbnail((size, size), Image.LANCZOS)
+    pil_format = OUTPUT_FORMATS[fmt][0]
+    save_kwargs = {}
+    if pil_format == "JPEG":
+        img = img.convert("RGB")  # JPEG has no alpha channel
+        save_kwargs = {"quality": OUTPUT_QUALITY, "optimize": True, "progressive": True}
+    elif pil_format in ("WEBP", "AVIF"):
+        save_kwargs = {"quality": OUTPUT_QUALITY}
+    else:
+        save_kwargs = {"optimize": True}
+    buffered = BytesIO()
+    img.save(buffered, format=pil_format, **save_kwargs)
+    return buffered.getvalue()
+
+def variant_path(image_id: str, fmt: str, size: int) -> str:
+    """Path of a cached variant; the original is stored as <id>.png next to its variants."""
+    if fmt == "png" and size == 1024:
+        return os.path.join(GENERATED_DIR, f"{image_id}.png")
+    return os.path.join(GENERATED_DIR, f"{image_id}_{size}_q{OUTPUT_QUALITY}.{fmt}")
+
+async def get_variant(image_id: str, fmt: str, size: int) -> bytes:
+    """Return the requested variant of a stored image, transcoding and caching it on first use."""
+    path = variant_path(image_id, fmt, size)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    with open(variant_path(image_id, "png", 1024), "rb") as f:
+        original = f.read()
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(transcode_pool, transcode_image, original, fmt, size)
+    # Write to a temp file first so concurrent readers never see a partial variant
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    print(f"Transcoded {image_id} to {fmt} {size}px: {len(original)} -> {len(data)} bytes")
+    return data
+
+def evict_generated():
+    """Delete stored images older than GENERATED_TTL, then the oldest ones until under GENERATED_MAX_BYTES."""
+    groups = {}  # image_id -> [created (oldest mtime), total bytes, paths]
+    for entry in os.scandir(GENERATED_DIR):
+        if not entry.is_file():
+            continue
+        image_id = entry.name.split("_")[0].split(".")[0]
+        stat = entry.stat()
+        group = groups.setdefault(image_id, [stat.st_mtime, 0, []])
+        group[0] = min(group[0], stat.st_mtime)
+        group[1] += stat.st_size
+        group[2].append(entry.path)
+
+    now = time.time()
+    total = sum(group[1] for group in groups.values())
+    evicted = 0
+    for image_id, (created, group_bytes, paths) in sorted(groups.items(), key=lambda item: item[1][0]):
+        if now - created < GENERATED_TTL and total <= GENERATED_MAX_BYTES:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= group_bytes
+        evicted += 1
+    if evicted:
+        print(f"Evicted {evicted} stored images, {total} bytes remain in {GENERATED_DIR}")
+
+def schedule_eviction():
+    """Run evict_generated in the transcode pool without holding up the response."""
+    def sweep():
+        try:
+            evict_generated()
+        except Exception as e:
+            print(f"Error evicting stored images: {e}")
+    asyncio.get_running_loop().run_in_executor(transcode_pool, sweep)
+
+def output_headers(image_id: str) -> dict:
+    return {"X-Image-Id": image_id, "Vary": "Accept", "Cache-Control": f"private, max-age={int(GENERATED_TTL)}"}
+
+# Admission control: bound in-flight upstream calls and the wait queue so that an
+# upstream slowdown sheds load with a fast 503 instead of timing everyone out.
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "4"))
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "16"))
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "90"))  # seconds a client is willing to wait in total
+
+PRIORITY_PAID = "paid"
+PRIORITY_ANONYMOUS = "anonymous"
+
+class Overloaded(Exception):
+    """Raised when a request is shed; carries the Retry-After hint in seconds."""
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Max in-flight limit with a bounded, two-lane (paid before anonymous) wait queue."""
+
+    def __init__(self, max_in_flight: int, max_queue: int, expected_seconds: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.latency_ewma = expected_seconds
+        self.in_flight = 0
+        self.lanes = {PRIORITY_PAID: deque(), PRIORITY_ANONYMOUS: deque()}
+
+    def queued(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def estimated_wait(self, position: int) -> float:
+        """Rough wait for the request at `position` in the queue (0 = next in line)."""
+        return (position // self.max_in_flight + 1) * self.latency_ewma
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.estimated_wait(self.queued())))
+
+    async def acquire(self, priority: str, deadline: float):
+        """Wait for an in-flight slot or raise Overloaded if it can't finish before `deadline` (monotonic)."""
+        if self.in_flight < self.max_in_flight and not self.queued():
+            self.in_flight += 1
+            return
+
+        # Paid requests queue ahead of every anonymous request
+        position = len(self.lanes[PRIORITY_PAID])
+        if priority == PRIORITY_ANONYMOUS:
+            position += len(self.lanes[PRIORITY_ANONYMOUS])
+        if time.monotonic() + self.estimated_wait(position) + self.latency_ewma > deadline:
+            raise Overloaded("Server is busy and the request could not finish in time", self.retry_after())
+        if self.queued() >= self.max_queue:
+            anonymous = self.lanes[PRIORITY_ANONYMOUS]
+            if priority != PRIORITY_PAID or not anonymous:
+                raise Overloaded("Server is busy, queue is full", self.retry_after())
+            # Make room for the paid request by shedding the most recently queued anonymous one
+            _, evicted = anonymous.pop()
+            if not evicted.done():
+                evicted.set_exception(Overloaded("Server is busy, request was preempted", self.retry_after()))
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (deadline, waiter)
+        self.lanes[priority].append(entry)
+        try:
+            # Give up once there is no longer time left to run the generation itself
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max(0.0, deadline - self.latency_ewma - time.monotonic()))
+        except asyncio.TimeoutError:
+            if entry in self.lanes[priority]:
+                self.lanes[priority].remove(entry)
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # A slot was handed over just as we timed out; pass it on
+                self.release()
+            raise Overloaded("Server is busy and the request could not finish in time", self.retry_after())
+        except asyncio.CancelledError:
+            # Client went away while queued
+            if entry in self.lanes[priority]:
+                self.lanes[priority].remove(entry)
+            elif waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+
+    def release(self, elapsed: float = None):
+        """Free a slot, recording the service time, and hand it to the next waiter that can still make its deadline."""
+        if elapsed is not None:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * elapsed
+        now = time.monotonic()
+        for priority in (PRIORITY_PAID, PRIORITY_ANONYMOUS):
+            lane = self.lanes[priority]
+            while lane:
+                deadline, waiter = lane.popleft()
+                if waiter.done():
+                    continue
+                if now + self.latency_ewma > deadline:
+                    waiter.set_exception(Overloaded("Server is busy and the request could not finish in time", self.retry_after()))
+                    continue
+                waiter.set_result(None)  # slot is transferred, in_flight stays the same
+                return
+        self.in_flight -= 1
+
+admission = AdmissionController(MAX_IN_FLIGHT, MAX_QUEUE, EXPECTED_GENERATION_SECONDS)
+
+# Paid status of Stripe checkout sessions, used to put paid-credit requests in the priority lane.
+# Filled by /api/confirm and the webhook, and otherwise by a rate-limited, time-boxed Stripe lookup
+# for unknown X-Session-Id values (e.g. after a restart or on another worker).
+PAID_SESSION_TTL = float(os.getenv("PAID_SESSION_TTL", str(30 * 24 * 3600)))
+UNPAID_SESSION_TTL = float(os.getenv("UNPAID_SESSION_TTL", "600"))  # unpaid sessions may still complete payment
+PAID_SESSION_CACHE_SIZE = int(os.getenv("PAID_SESSION_CACHE_SIZE", "10000"))
+STRIPE_LOOKUPS_PER_MINUTE = float(os.getenv("STRIPE_LOOKUPS_PER_MINUTE", "30"))
+STRIPE_LOOKUP_TIMEOUT = float(os.getenv("STRIPE_LOOKUP_TIMEOUT", "2"))
+
+class PaidSessionCache:
+    """Bounded TTL cache of checkout session ID -> paid; the least recently stored entries are dropped first."""
+
+    def __init__(self, max_size: int, ttl: float, unpaid_ttl: float, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.unpaid_ttl = unpaid_ttl
+        self.clock = clock
+        self.entries = OrderedDict()  # session_id -> (paid, expiry time on `clock`)
+
+    def add(self, session_id: str, paid: bool = True):
+        self.entries.pop(session_id, None)
+        self.entries[session_id] = (paid, self.clock() + (self.ttl if paid else self.unpaid_ttl))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, session_id: str):
+        """True/False if known, None if never seen or expired."""
+        entry = self.entries.get(session_id)
+        if entry is None:
+            return None
+        paid, expiry = entry
+        if expiry < self.clock():
+            del self.entries[session_id]
+            return None
+        return paid
+
+class RateLimiter:
+    """Token bucket allowing `per_minute` operations on average, in bursts of up to `burst`."""
+
+    def __init__(self, per_minute: float, burst: float, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def allow(self) -> bool:
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+paid_sessions = PaidSessionCache(PAID_SESSION_CACHE_SIZE, PAID_SESSION_TTL, UNPAID_SESSION_TTL)
+stripe_lookups = RateLimiter(STRIPE_LOOKUPS_PER_MINUTE, burst=max(1.0, STRIPE_LOOKUPS_PER_MINUTE / 6))
+
+async def lookup_session(session_id: str):
+    """Ask Stripe whether a session is paid and cache the answer; None (not cached) if we couldn't tell."""
+    if not stripe_lookups.allow():
+        print(f"Stripe lookup rate limit reached, treating session {session_id} as anonymous for now")
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        session = await asyncio.wait_for(
+            loop.run_in_executor(None, stripe.checkout.Session.retrieve, session_id), timeout=STRIPE_LOOKUP_TIMEOUT
+        )
+    except stripe.error.InvalidRequestError:
+        paid_sessions.add(session_id, paid=False)  # no such session
+        return False
+    except Exception as e:
+        # Transient (timeout, network, Stripe outage): don't cache, so the customer keeps priority next time
+        print(f"Could not verify session {session_id} for priority: {e!r}")
+        return None
+    paid = session.payment_status == 'paid'
+    paid_sessions.add(session_id, paid=paid)
+    return paid
+
+async def request_priority(session_id: str) -> str:
+    """Paid lane for clients presenting a paid Stripe checkout session, anonymous lane otherwise."""
+    if not session_id or not session_id.startswith("cs_"):
+        return PRIORITY_ANONYMOUS
+    paid = paid_sessions.get(session_id)
+    if paid is None:
+        paid = await lookup_session(session_id)
+    return PRIORITY_PAID if paid else PRIORITY_ANONYMOUS
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# An admitted request holds a generation slot while its upload arrives, so the upload must finish within this
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", str(REQUEST_DEADLINE / 3)))
+
+class UploadTimeout(Exception):
+    pass
+
+class AdmissionMiddleware:
+    """
+    Admits /api/generate requests before their multipart body is received, so queued and shed
+    requests never buffer an upload. Priority comes from the X-Session-Id header for that reason.
+    Once admitted, the body must arrive within UPLOAD_TIMEOUT or the request fails with 408, so
+    stalled clients can't hold generation slots.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/api/generate":
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        content_length = headers.get("content-length")
+        if content_length is None:
+            return await JSONResponse(status_code=411, content={"error": "Content-Length required"})(scope, receive, send)
+        try:
+            upload_bytes = int(content_length)
+        except ValueError:
+            return await JSONResponse(status_code=400, content={"error": "Invalid Content-Length"})(scope, receive, send)
+        if upload_bytes > MAX_UPLOAD_BYTES:
+            return await JSONResponse(
+                status_code=413, content={"error": f"Upload larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"}
+            )(scope, receive, send)
+
+        arrived = time.monotonic()
+        priority = await request_priority(headers.get("x-session-id"))
+        try:
+            await admission.acquire(priority, arrived + REQUEST_DEADLINE)
+        except Overloaded as e:
+            print(f"Shedding {priority} request: {e} (in flight: {admission.in_flight}, queued: {admission.queued()})")
+            return await JSONResponse(
+                status_code=503, content={"error": str(e)}, headers={"Retry-After": str(e.retry_after)}
+            )(scope, receive, send)
+
+        admitted = time.monotonic()
+        upload_deadline = min(admitted + UPLOAD_TIMEOUT, arrived + REQUEST_DEADLINE)
+        body_complete = False
+        timed_out = False
+        response_started = False
+
+        async def receive_with_deadline():
+            nonlocal body_complete, timed_out
+            if body_complete:
+                return await receive()
+            try:
+                message = await asyncio.wait_for(receive(), timeout=max(0.0, upload_deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                timed_out = True
+                raise UploadTimeout()
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                body_complete = True
+            return message
+
+        async def send_unless_timed_out(message):
+            nonlocal response_started
+            if timed_out:
+                return  # the body-parsing error response is replaced by the 408 below
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_with_deadline, send_unless_timed_out)
+        except UploadTimeout:
+            pass
+        finally:
+            # The slot is held from admission until the response, upload included, so that's what the EWMA tracks
+            admission.release(time.monotonic() - admitted)
+        if timed_out and not response_started:
+            print(f"Upload timed out after {time.monotonic() - admitted:.1f}s, releasing slot")
+            await JSONResponse(status_code=408, content={"error": "Upload took too long"})(scope, receive, send)
+
+app.add_middleware(AdmissionMiddleware)
+
+# CORS for frontend; registered after AdmissionMiddleware so it wraps it and 503s carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*", FRONTEND_URL, "http://localhost:3000", "http://127.0.0.1:3000", "http://127.0.0.1:50224"],
     allow_methods=["*"],
     allow_credentials=True,
     allow_headers=["*"],
+    expose_headers=["X-Image-Id", "Retry-After"],
 )
 
-# Define Price Options (Map IDs to amount in cents and credits)
-PRICE_OPTIONS = {
-    "price_3": {"amount": 300, "credits": 10, "name": "10 Photo Credits Pack"},
-    "price_10": {"amount": 1000, "credits": 50, "name": "50 Photo Credits Pack"}
-}
-
 @app.post("/api/generate")
-async def generate(file: UploadFile = File(...), prompt: str = Form("")):
+async def generate(
+    file: UploadFile = File(...),
+    prompt: str = Form(""),
+    output_format: str = Form(None),
+    output_size: int = Form(None),
+    accept: str = Header(None),
+):
     """
-    Receives an image and prompt, creates a Jujutsu Kaisen style version using OpenAI's gpt-image-1 edit API.
+    Receives an image and prompt, creates a Jujutsu Kaisen style version using the configured image providers.
+    The result is returned in the format/size negotiated via `output_format`/`output_size` or the Accept header.
+    Admission control (see AdmissionMiddleware) has already run by the time this is called.
     """
+    try:
+        fmt, size = negotiate_output(accept, output_format, output_size)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    return await run_generation(file, prompt, fmt, size)
+
+async def run_generation(file: UploadFile, prompt: str, fmt: str, size: int):
+    """Preprocess the upload, call the image providers and return the negotiated variant."""
     try:
         # 1. Read the uploaded file contents
         contents = await file.read()
@@ -86,15 +837,6 @@ async def generate(file: UploadFile = File(...), prompt: str = Form("")):
             # Fallback: use original contents if preprocessing failed
             pass
 
-        # Define filename and create the tuple for file upload
-        image_filename = "uploaded_image.png"
-        # Use the raw 'contents' bytes in the tuple, per SDK docs
-        image_data_tuple = (image_filename, contents, "image/png")
-
-        # Initialize OpenAI Client with custom HTTP client to disable proxy env vars
-        custom_http_client = httpx.AsyncClient(trust_env=False)
-        client = AsyncOpenAI(api_key=openai_key, http_client=custom_http_client)
-
         # 4. Define the JJK style prompt and combine with user prompt
         jjk_style_prompt = (
             "masterpiece, best quality, official Studio MAPPA artwork from Jujutsu Kaisen anime, "
@@ -107,31 +849,25 @@ async def generate(file: UploadFile = File(...), prompt: str = Form("")):
             "highly detailed background art, professional anime key visual quality"
         )
         final_prompt = jjk_style_prompt + f" {prompt}" if prompt else jjk_style_prompt
-        print(f"Final prompt for OpenAI: {final_prompt}")
+        print(f"Final prompt: {final_prompt}")
 
-        # 5. Call OpenAI Image Edit API
-        print(f"Calling OpenAI images.edit with model gpt-image-1...")
-        async with client:
-            response = await client.images.edit(
-                model="gpt-image-1",
-                image=image_data_tuple, # Pass tuple: (filename, raw_bytes, mimetype)
-                prompt=final_prompt,
-                n=1,
-                size="1024x1024" # Standard size
-            )
-        
-        # 6. Process the response
-        b64_image = response.data[0].b64_json
-        print(f"Successfully received image from OpenAI. Size: {len(b64_image)} chars")
-        # 7. Decode the base64 string to raw bytes
-        image_bytes = base64.b64decode(b64_image)
-        print(f"Decoded image to {len(image_bytes)} bytes")
-
-        # 8. Return the raw image bytes with the correct media type
-        return Response(content=image_bytes, media_type="image/png")
-
-    except Exception as e: # Consider more specific OpenAI exceptions later if needed
-        error_message = f"Error calling OpenAI API: {e}"
+        # 5. Call the image providers (hedged / with failover)
+        provider_name, image_bytes = await provider_pool.generate(contents, final_prompt)
+        print(f"Received image from {provider_name}: {len(image_bytes)} bytes")
+
+        # 8. Store the original so variants can be cached next to it
+        image_id = hashlib.sha256(image_bytes).hexdigest()[:32]
+        with open(variant_path(image_id, "png", 1024), "wb") as f:
+            f.write(image_bytes)
+        schedule_eviction()
+
+        # 9. Return the negotiated variant with the correct media type
+        if fmt != "png" or size != 1024:
+            image_bytes = await get_variant(image_id, fmt, size)
+        return Response(content=image_bytes, media_type=OUTPUT_FORMATS[fmt][1], headers=output_headers(image_id))
+
+    except Exception as e: # Consider more specific provider exceptions later if needed
+        error_message = f"Error calling image provider: {e}"
         print(error_message)
         # Consider mapping specific OpenAI errors to user-friendly messages
         status_code = 500 # Default to internal server error
@@ -143,6 +879,29 @@ async def generate(file: UploadFile = File(...), prompt: str = Form("")):
              status_code = e.status_code
         return JSONResponse(status_code=status_code, content={"error": f"Image generation failed: {str(e)}"}) 
 
+@app.get("/api/images/{image_id}")
+async def get_image(image_id: str, output_format: str = None, output_size: int = None, accept: str = Header(None)):
+    """Serve a previously generated image in another format/size, using the cached variant when present."""
+    if len(image_id) != 32 or any(c not in "0123456789abcdef" for c in image_id):
+        return JSONResponse(status_code=400, content={"error": "Invalid image ID"})
+    if not os.path.exists(variant_path(image_id, "png", 1024)):
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    try:
+        fmt, size = negotiate_output(accept, output_format, output_size)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    try:
+        image_bytes = await get_variant(image_id, fmt, size)
+    except FileNotFoundError:
+        # Evicted between the existence check and the read
+        return JSONResponse(status_code=404, content={"error": "Image not found"})
+    return Response(content=image_bytes, media_type=OUTPUT_FORMATS[fmt][1], headers=output_headers(image_id))
+
+@app.get("/api/providers")
+async def providers():
+    """Health and latency of each configured image provider."""
+    return {"hedging": HEDGE_REQUESTS, "providers": provider_pool.status()}
+
 @app.get("/api/checkout")
 async def checkout(price_id: str = None):
     """Redirects user to Stripe Checkout for buying credits based on price_id"""
@@ -186,6 +945,7 @@ async def confirm(session_id: str):
             # Retrieve credits from metadata
             credits_to_add = int(session.metadata.get('credits_to_add', '0')) 
             if credits_to_add > 0:
+                 paid_sessions.add(session_id)
                  print(f"Payment confirmed for session {session_id}, adding {credits_to_add} credits.")
                  return {"credits": credits_to_add}
             else:
@@ -234,6 +994,7 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         # Since credits are handled client-side via /api/confirm after redirect,
         # we just log it here for confirmation.
         print(f"Payment successful (via webhook) for session: {session.id}")
+        paid_sessions.add(session.id)
         # TODO: Add any backend fulfillment logic here if needed beyond client-side credits
 
     else:
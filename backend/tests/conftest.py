@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.main reads its configuration at import time. Always use fake providers (no API or Stripe
+# keys, and never billed upstream calls), even if the shell exports IMAGE_PROVIDERS.
+os.environ["IMAGE_PROVIDERS"] = "fake:0.01:0"
+os.environ.setdefault("GENERATED_DIR", tempfile.mkdtemp(prefix="generated-"))
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,285 @@
+import asyncio
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import stripe
+from PIL import Image
+
+from app import main
+
+
+def test_paid_session_cache_is_bounded_and_expires():
+    now = [1000.0]
+    cache = main.PaidSessionCache(max_size=2, ttl=60, unpaid_ttl=10, clock=lambda: now[0])
+    cache.add("cs_a")
+    cache.add("cs_b")
+    cache.add("cs_unpaid", paid=False)
+    assert cache.get("cs_a") is None
+    assert cache.get("cs_b") is True
+    assert cache.get("cs_unpaid") is False
+
+    now[0] += 11
+    assert cache.get("cs_unpaid") is None
+    assert cache.get("cs_b") is True
+    now[0] += 50
+    assert cache.get("cs_b") is None
+    assert len(cache.entries) == 0
+
+
+def test_rate_limiter_refills_over_time():
+    now = [0.0]
+    limiter = main.RateLimiter(per_minute=60, burst=2, clock=lambda: now[0])
+    assert [limiter.allow() for _ in range(3)] == [True, True, False]
+    now[0] += 1
+    assert limiter.allow() and not limiter.allow()
+
+
+class FakeStripeSessions:
+    """Stands in for stripe.checkout.Session.retrieve."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = []
+
+    def retrieve(self, session_id):
+        self.calls.append(session_id)
+        status = self.statuses[session_id]
+        if isinstance(status, Exception):
+            raise status
+        return SimpleNamespace(payment_status=status)
+
+
+@pytest.fixture
+def stripe_sessions(monkeypatch):
+    def install(statuses, per_minute=60):
+        fake = FakeStripeSessions(statuses)
+        monkeypatch.setattr(stripe.checkout.Session, "retrieve", fake.retrieve)
+        monkeypatch.setattr(main, "paid_sessions", main.PaidSessionCache(10, 60, 60))
+        monkeypatch.setattr(main, "stripe_lookups", main.RateLimiter(per_minute, burst=max(1, per_minute)))
+        return fake
+    return install
+
+
+def _priority(session_id):
+    return asyncio.run(main.request_priority(session_id))
+
+
+def test_confirmed_sessions_are_paid_without_stripe_lookup(stripe_sessions):
+    fake = stripe_sessions({})
+    main.paid_sessions.add("cs_paid")
+    assert _priority("cs_paid") == main.PRIORITY_PAID
+    assert _priority(None) == main.PRIORITY_ANONYMOUS
+    assert _priority("not-a-session") == main.PRIORITY_ANONYMOUS
+    assert fake.calls == []
+
+
+def test_unknown_sessions_are_verified_once_and_cached(stripe_sessions):
+    fake = stripe_sessions({"cs_paid": "paid", "cs_unpaid": "unpaid",
+                            "cs_bogus": stripe.error.InvalidRequestError("No such session", None)})
+    for _ in range(2):
+        assert _priority("cs_paid") == main.PRIORITY_PAID
+        assert _priority("cs_unpaid") == main.PRIORITY_ANONYMOUS
+        assert _priority("cs_bogus") == main.PRIORITY_ANONYMOUS
+    assert fake.calls == ["cs_paid", "cs_unpaid", "cs_bogus"]
+
+
+def test_transient_stripe_errors_are_not_cached(stripe_sessions):
+    fake = stripe_sessions({"cs_paid": stripe.error.APIConnectionError("network down")})
+    assert _priority("cs_paid") == main.PRIORITY_ANONYMOUS
+    fake.statuses["cs_paid"] = "paid"
+    assert _priority("cs_paid") == main.PRIORITY_PAID
+    assert fake.calls == ["cs_paid", "cs_paid"]
+
+
+def test_stripe_lookups_are_rate_limited(stripe_sessions):
+    fake = stripe_sessions({f"cs_{i}": "unpaid" for i in range(10)}, per_minute=3)
+    for i in range(10):
+        assert _priority(f"cs_{i}") == main.PRIORITY_ANONYMOUS
+    assert len(fake.calls) == 3
+
+
+def _waiter(controller, priority, deadline=30):
+    return asyncio.create_task(controller.acquire(priority, time.monotonic() + deadline))
+
+
+def test_release_hands_slot_to_paid_before_anonymous():
+    async def scenario():
+        controller = main.AdmissionController(max_in_flight=1, max_queue=4, expected_seconds=1)
+        await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 30)
+        anonymous = _waiter(controller, main.PRIORITY_ANONYMOUS)
+        paid = _waiter(controller, main.PRIORITY_PAID)
+        await asyncio.sleep(0.01)
+        controller.release(1.0)
+        await asyncio.sleep(0.01)
+        assert paid.done() and not anonymous.done()
+        controller.release(1.0)
+        await anonymous
+        assert controller.in_flight == 1
+    asyncio.run(scenario())
+
+
+def test_full_queue_preempts_newest_anonymous_for_paid():
+    async def scenario():
+        controller = main.AdmissionController(max_in_flight=1, max_queue=2, expected_seconds=1)
+        await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 30)
+        first = _waiter(controller, main.PRIORITY_ANONYMOUS)
+        newest = _waiter(controller, main.PRIORITY_ANONYMOUS)
+        await asyncio.sleep(0.01)
+        paid = _waiter(controller, main.PRIORITY_PAID)
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.Overloaded):
+            await newest
+        assert not first.done()
+
+        # Anonymous requests are shed outright when the queue is full
+        with pytest.raises(main.Overloaded):
+            await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 30)
+
+        controller.release(1.0)
+        await paid
+        assert not first.done()
+        first.cancel()
+    asyncio.run(scenario())
+
+
+def test_requests_that_cannot_meet_their_deadline_are_shed():
+    async def scenario():
+        controller = main.AdmissionController(max_in_flight=1, max_queue=4, expected_seconds=1)
+        await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 30)
+        # Estimated wait + service time is 2s, more than this request's deadline
+        with pytest.raises(main.Overloaded) as excinfo:
+            await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 1.5)
+        assert excinfo.value.retry_after >= 1
+
+        # Admitted to the queue, but gives up once too little time is left to run
+        controller.latency_ewma = 0.05
+        queued = _waiter(controller, main.PRIORITY_ANONYMOUS, deadline=0.2)
+        with pytest.raises(main.Overloaded):
+            await queued
+        assert controller.queued() == 0
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_its_slot():
+    async def scenario():
+        controller = main.AdmissionController(max_in_flight=1, max_queue=4, expected_seconds=1)
+        await controller.acquire(main.PRIORITY_ANONYMOUS, time.monotonic() + 30)
+        gone = _waiter(controller, main.PRIORITY_ANONYMOUS)
+        behind = _waiter(controller, main.PRIORITY_ANONYMOUS)
+        await asyncio.sleep(0.01)
+
+        # `gone`'s client disconnects while queued; the next release must skip it
+        gone.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await gone
+        assert controller.queued() == 1
+        controller.release(1.0)
+        await behind
+        assert controller.in_flight == 1
+        controller.release(1.0)
+        assert controller.in_flight == 0
+    asyncio.run(scenario())
+
+
+def _png_bytes():
+    buffered = BytesIO()
+    Image.new("RGB", (8, 8), (73, 109, 137)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def _post_generate(**kwargs):
+    async def post():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post(
+                "/api/generate", files={"file": ("photo.png", _png_bytes(), "image/png")}, data={"prompt": "test"}, **kwargs
+            )
+    return asyncio.run(post())
+
+
+def test_generate_sheds_with_retry_after_and_cors(monkeypatch):
+    controller = main.AdmissionController(max_in_flight=1, max_queue=0, expected_seconds=10)
+    controller.in_flight = 1
+    monkeypatch.setattr(main, "admission", controller)
+
+    response = _post_generate(headers={"Origin": "http://localhost:3000"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "10"
+    assert "access-control-allow-origin" in response.headers
+
+
+def test_generate_rejects_oversized_upload(monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 10)
+    assert _post_generate().status_code == 413
+
+
+def test_generate_releases_slot_and_records_generation_time(monkeypatch):
+    controller = main.AdmissionController(max_in_flight=1, max_queue=0, expected_seconds=10)
+    monkeypatch.setattr(main, "admission", controller)
+
+    async def generate(image_bytes, prompt):
+        return "stub", image_bytes
+    monkeypatch.setattr(main.provider_pool, "generate", generate)
+
+    response = _post_generate(headers={"Accept": "image/png"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert controller.in_flight == 0
+    assert controller.latency_ewma < 10
+
+
+def _generate_scope():
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": "/api/generate", "raw_path": b"/api/generate", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"testserver"), (b"content-type", b"multipart/form-data; boundary=x"), (b"content-length", b"1000")],
+        "client": ("127.0.0.1", 1234), "server": ("testserver", 80),
+    }
+
+
+def test_shed_requests_never_receive_the_upload(monkeypatch):
+    controller = main.AdmissionController(max_in_flight=1, max_queue=0, expected_seconds=10)
+    controller.in_flight = 1
+    monkeypatch.setattr(main, "admission", controller)
+    body_reads = []
+    sent = []
+
+    async def receive():
+        body_reads.append(1)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(main.app(_generate_scope(), receive, send))
+
+    assert sent[0]["status"] == 503
+    assert body_reads == []
+
+
+
+def test_stalled_upload_times_out_and_frees_its_slot(monkeypatch):
+    controller = main.AdmissionController(max_in_flight=1, max_queue=0, expected_seconds=1)
+    monkeypatch.setattr(main, "admission", controller)
+    monkeypatch.setattr(main, "UPLOAD_TIMEOUT", 0.1)
+    chunks = [{"type": "http.request", "body": b"--x\r\n", "more_body": True}]
+    sent = []
+
+    async def receive():
+        if chunks:
+            return chunks.pop()
+        await asyncio.Event().wait()  # client stalls mid-upload
+
+    async def send(message):
+        sent.append(message)
+
+    started = time.monotonic()
+    asyncio.run(main.app(_generate_scope(), receive, send))
+
+    assert [m["status"] for m in sent if m["type"] == "http.response.start"] == [408]
+    assert controller.in_flight == 0
+    # The slot hold time, upload included, feeds the EWMA used for wait estimates
+    assert controller.latency_ewma == pytest.approx(0.8 * 1 + 0.2 * (time.monotonic() - started), abs=0.05)
@@ -0,0 +1,53 @@
+import os
+import time
+
+import pytest
+
+from app import main
+
+
+def test_accept_header_picks_highest_q():
+    assert main.negotiate_output("image/png, image/jpeg;q=0.8", None, None) == ("png", 1024)
+    assert main.negotiate_output("image/webp;q=0.5, image/jpeg;q=0.9", None, None) == ("jpeg", 1024)
+
+
+def test_accept_header_ties_follow_output_preference():
+    assert main.negotiate_output("image/png, image/jpeg, image/webp", None, None) == ("webp", 1024)
+    if "avif" in main.OUTPUT_PREFERENCE:
+        assert main.negotiate_output("image/webp,image/avif", None, None) == ("avif", 1024)
+
+
+def test_wildcards_keep_png():
+    assert main.negotiate_output("application/json, text/plain, */*", None, None) == ("png", 1024)
+    assert main.negotiate_output("image/webp;q=0", None, None) == ("png", 1024)
+
+
+def test_form_fields_override_accept():
+    assert main.negotiate_output("image/webp", "JPG", 512) == ("jpeg", 512)
+    with pytest.raises(ValueError):
+        main.negotiate_output(None, "gif", None)
+    with pytest.raises(ValueError):
+        main.negotiate_output(None, None, 300)
+
+
+def _store(directory, name, size, age):
+    path = directory / name
+    path.write_bytes(b"x" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def test_eviction_by_age_and_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "GENERATED_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "GENERATED_TTL", 3600)
+    monkeypatch.setattr(main, "GENERATED_MAX_BYTES", 250)
+    _store(tmp_path, "expired.png", 10, 7200)
+    _store(tmp_path, "expired_512_q80.webp", 10, 60)  # variants go with their original
+    _store(tmp_path, "oldest.png", 100, 300)
+    _store(tmp_path, "older.png", 100, 200)
+    _store(tmp_path, "newest.png", 100, 100)
+    _store(tmp_path, "newest_256_q80.jpeg", 10, 50)
+
+    main.evict_generated()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["newest.png", "newest_256_q80.jpeg", "older.png"]
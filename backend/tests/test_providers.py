@@ -0,0 +1,201 @@
+import asyncio
+import time
+from io import BytesIO
+
+import httpx
+import pytest
+from PIL import Image
+
+from app import main
+
+
+def test_duplicate_provider_names_are_rejected():
+    with pytest.raises(ValueError, match="fake:1:0"):
+        main.ProviderPool([main.create_provider("fake:1:0"), main.create_provider("fake:1:0")], hedge=False)
+
+
+class StubProvider(main.ImageProvider):
+    """Provider with a fixed latency that either returns its name or raises `error`."""
+
+    def __init__(self, name, latency=0.0, error=None):
+        self.name = name
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+
+    async def edit(self, image_bytes, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return self.name.encode()
+
+
+def test_adapter_without_edit_fails_when_built():
+    class HalfWritten(main.ImageProvider):
+        name = "half"
+
+    with pytest.raises(TypeError):
+        HalfWritten()
+
+
+def _generate(pool):
+    return asyncio.run(pool.generate(b"image", "prompt"))
+
+
+def test_provider_errors_fail_over():
+    failing = StubProvider("primary", error=main.ProviderRequestError(503, "unavailable"))
+    backup = StubProvider("backup")
+    pool = main.ProviderPool([failing, backup], hedge=False)
+    assert _generate(pool) == ("backup", b"backup")
+    assert pool.stats["primary"].consecutive_failures == 1
+
+
+@pytest.mark.parametrize("status_code", [401, 402, 403, 404, 408, 429])
+def test_provider_side_4xx_fails_over_and_trips_breaker(status_code):
+    primary = StubProvider("primary", error=main.ProviderRequestError(status_code, "invalid api key"))
+    backup = StubProvider("backup")
+    pool = main.ProviderPool([primary, backup], hedge=False)
+    for _ in range(main.PROVIDER_FAILURE_THRESHOLD):
+        assert _generate(pool) == ("backup", b"backup")
+    assert not pool.stats["primary"].healthy()
+
+
+def test_provider_side_4xx_is_not_returned_to_the_caller():
+    pool = main.ProviderPool([StubProvider("primary", error=main.ProviderRequestError(401, "invalid api key"))], hedge=False)
+    with pytest.raises(main.AllProvidersFailed) as excinfo:
+        _generate(pool)
+    assert excinfo.value.status_code == 502
+
+
+@pytest.mark.parametrize("status_code", [400, 413, 422])
+def test_client_errors_go_straight_to_the_caller(status_code):
+    rejecting = StubProvider("primary", error=main.ProviderRequestError(status_code, "rejected input"))
+    backup = StubProvider("backup")
+    pool = main.ProviderPool([rejecting, backup], hedge=False)
+    for _ in range(main.PROVIDER_FAILURE_THRESHOLD + 1):
+        with pytest.raises(main.ProviderRequestError) as excinfo:
+            _generate(pool)
+        assert excinfo.value.status_code == status_code
+    assert backup.calls == 0
+    assert pool.stats["primary"].healthy()
+    assert pool.stats["primary"].consecutive_failures == 0
+
+
+def test_content_policy_code_goes_straight_to_the_caller():
+    error = main.ProviderRequestError(403, "blocked by moderation")
+    error.code = "moderation_blocked"
+    backup = StubProvider("backup")
+    pool = main.ProviderPool([StubProvider("primary", error=error), backup], hedge=False)
+    with pytest.raises(main.ProviderRequestError):
+        _generate(pool)
+    assert backup.calls == 0
+
+
+async def _run_sequentially(pool, requests):
+    winners = []
+    for _ in range(requests):
+        name, _ = await pool.generate(b"image", "prompt")
+        winners.append(name)
+        await asyncio.sleep(0.01)  # let the cancelled hedge loser record its latency
+    return winners
+
+
+def test_slow_primary_is_demoted_after_losing_hedges(monkeypatch):
+    monkeypatch.setattr(main, "EXPECTED_GENERATION_SECONDS", 0.05)
+    slow, fast = StubProvider("slow", latency=0.3), StubProvider("fast", latency=0.05)
+    pool = main.ProviderPool([slow, fast], hedge=True)
+
+    winners = asyncio.run(_run_sequentially(pool, 10))
+
+    assert winners.count("fast") >= 8
+    assert slow.calls <= 3  # hedged or probed only until it was demoted
+    assert pool.stats["slow"].latency_ewma > main.PROVIDER_DEMOTE_RATIO * pool.stats["fast"].latency_ewma
+    assert pool.ordered()[0] is fast
+
+
+def test_hedging_is_capped_by_budget(monkeypatch):
+    monkeypatch.setattr(main, "EXPECTED_GENERATION_SECONDS", 0.01)
+    monkeypatch.setattr(main, "PROVIDER_DEMOTE_RATIO", 1000.0)  # keep the slow provider as primary
+    slow, fast = StubProvider("slow", latency=0.05), StubProvider("fast", latency=0.01)
+    pool = main.ProviderPool([slow, fast], hedge=True)
+
+    asyncio.run(_run_sequentially(pool, 30))
+
+    assert fast.calls <= 1 + 30 * main.HEDGE_BUDGET
+
+
+def test_hedge_wins_when_primary_exceeds_its_latency(monkeypatch):
+    monkeypatch.setattr(main, "EXPECTED_GENERATION_SECONDS", 0.02)
+    pool = main.ProviderPool([StubProvider("slow", latency=1.0), StubProvider("fast", latency=0.01)], hedge=True)
+    started = time.monotonic()
+    assert _generate(pool) == ("fast", b"fast")
+    assert time.monotonic() - started < 0.5
+
+
+def test_breaker_opens_after_threshold_and_closes_after_cooldown():
+    failing = StubProvider("primary", error=main.ProviderRequestError(502, "bad gateway"))
+    backup = StubProvider("backup")
+    pool = main.ProviderPool([failing, backup], hedge=False)
+    for _ in range(main.PROVIDER_FAILURE_THRESHOLD):
+        assert _generate(pool) == ("backup", b"backup")
+    assert not pool.stats["primary"].healthy()
+    assert pool.ordered() == [backup, failing]
+
+    # While open, the unhealthy provider isn't called at all
+    _generate(pool)
+    assert failing.calls == main.PROVIDER_FAILURE_THRESHOLD
+
+    pool.stats["primary"].unhealthy_until = time.monotonic() - 1
+    assert pool.ordered() == [failing, backup]
+
+
+def test_all_providers_failing_surfaces_last_status():
+    pool = main.ProviderPool([
+        StubProvider("a", error=RuntimeError("connection reset")),
+        StubProvider("b", error=main.ProviderRequestError(503, "unavailable")),
+    ], hedge=False)
+    with pytest.raises(main.AllProvidersFailed) as excinfo:
+        _generate(pool)
+    assert excinfo.value.status_code == 503
+    assert [name for name, _ in excinfo.value.errors] == ["a", "b"]
+
+
+def test_fake_provider_spec():
+    provider = main.create_provider("fake:0:1")
+    assert (provider.name, provider.latency, provider.failure_rate) == ("fake:0:1", 0.0, 1.0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(provider.edit(b"", "prompt"))
+    with pytest.raises(ValueError):
+        main.create_provider("dalle")
+
+
+def test_generate_end_to_end_with_fake_provider():
+    buffered = BytesIO()
+    Image.new("RGB", (8, 8), (73, 109, 137)).save(buffered, format="PNG")
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            response = await client.post(
+                "/api/generate", files={"file": ("photo.png", buffered.getvalue(), "image/png")},
+                data={"prompt": "test"}, headers={"Accept": "image/webp"},
+            )
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "image/webp"
+            return await client.get(
+                f"/api/images/{response.headers['x-image-id']}", params={"output_format": "jpeg", "output_size": 256}
+            )
+    variant = asyncio.run(scenario())
+    assert variant.status_code == 200
+    assert variant.headers["content-type"] == "image/jpeg"
+
+
+def test_hanging_provider_times_out_and_fails_over(monkeypatch):
+    monkeypatch.setattr(main, "PROVIDER_TIMEOUT", 0.05)
+    hanging, backup = StubProvider("hanging", latency=10), StubProvider("backup")
+    pool = main.ProviderPool([hanging, backup], hedge=False)
+    started = time.monotonic()
+    assert _generate(pool) == ("backup", b"backup")
+    assert time.monotonic() - started < 1
+    assert pool.stats["hanging"].consecutive_failures == 1
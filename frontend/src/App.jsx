@@ -49,6 +49,13 @@ async function initDB() {
 }
 // ----------------------
 
+// File extension for a downloaded image, based on the blob's MIME type (e.g. image/webp -> webp)
+function extensionForType(type) {
+  const subtype = (type || '').split('/')[1];
+  if (!subtype) return 'png';
+  return subtype === 'jpeg' ? 'jpg' : subtype.split('+')[0];
+}
+
 function App() {
   const [file, setFile] = useState(null);
   const [prompt, setPrompt] = useState('');
@@ -124,7 +131,8 @@ function App() {
           }
           return {
             id: item.id, 
-            url: url 
+            url: url,
+            type: item.blob.type
           };
         }).filter(item => item.url !== null); // Filter out items where URL creation failed
 
@@ -161,6 +169,7 @@ function App() {
             const purchasedCredits = parseInt(res.data.credits, 10);
             if (!isNaN(purchasedCredits) && purchasedCredits > 0) {
               console.log(`Purchase confirmed! Adding ${purchasedCredits} credits.`);
+              localStorage.setItem('paidSessionId', sessionId); // Lets the backend prioritise paid requests
               setCredits(prev => {
                   const newTotal = prev + purchasedCredits;
                   localStorage.setItem('credits', newTotal.toString()); // Update localStorage
@@ -227,7 +236,11 @@ function App() {
     try {
       console.log('Sending image to backend, file size:', file.size);
       const response = await axios.post(`${API_BASE_URL}/api/generate`, formData, {
-        responseType: 'blob' // Ensure we get a Blob back
+        responseType: 'blob', // Ensure we get a Blob back
+        headers: {
+          Accept: 'image/avif,image/webp;q=0.9,image/png;q=0.5', // Much smaller than the upstream PNG
+          ...(localStorage.getItem('paidSessionId') ? { 'X-Session-Id': localStorage.getItem('paidSessionId') } : {}) // Priority lane for paid users
+        }
       });
       
       console.log('Raw Axios Response:', response);
@@ -253,7 +266,7 @@ function App() {
           if (objectUrl) { // Only update state if URL was created
               // Add to gallery state (newest first) and update credits
               setGallery(prev => {
-                  const newState = [{ id: newItemId, url: objectUrl }, ...prev];
+                  const newState = [{ id: newItemId, url: objectUrl, type: imageBlob.type }, ...prev];
                   console.log('Updated gallery state with new item. New length:', newState.length); // Log state update
                   return newState;
               });
@@ -282,6 +295,11 @@ function App() {
         console.error("Error Response:", err.response.data);
         console.error("Error Status:", err.response.status);
         console.error("Error Headers:", err.response.headers);
+        if (err.response.status === 503) {
+          const retryAfter = err.response.headers['retry-after'];
+          alert(`The server is busy right now. Please try again${retryAfter ? ` in about ${retryAfter} seconds` : ' shortly'}.`);
+          return;
+        }
         alert(`API Error (${err.response.status}): ${JSON.stringify(err.response.data)}`);
       } else if (err.request) {
         // The request was made but no response was received
@@ -404,7 +422,7 @@ function App() {
                   <img src={item.url} alt={`gen-${item.id}`} style={{ width: '100%', borderRadius: '8px' }} />
                   <a 
                     href={item.url} 
-                    download={`jujutsu-kaisen-image-${item.id}.png`}
+                    download={`jujutsu-kaisen-image-${item.id}.${extensionForType(item.type)}`}
                     style={{
                       display: 'block',
                       marginTop: '10px',